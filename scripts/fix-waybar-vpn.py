@@ -12,98 +12,140 @@ The script is idempotent - safe to run multiple times.
 """
 
 import json
+import mmap
 import os
 import re
 import shutil
 import stat
 import sys
+from pathlib import Path
+
+try:
+    import pyjson5  # Optional C parser, used only for the idempotency check
+except ImportError:
+    pyjson5 = None
 
 # Nerd Font icons (verified codepoints)
 ICON_LOCK = "\U000F033E"  # nf-md-lock (connected)
 ICON_LOCK_OPEN = "\U000F0FC6"  # nf-md-lock_open_outline (disconnected)
 
+# Waybar config directory (~ expanded once)
+_WAYBAR = os.path.join(os.path.expanduser("~"), ".config/waybar")
+
+# Precompiled patterns used when editing config.jsonc
+_TRAY_RE = re.compile(r'("group/tray-expander"\s*)(,)')
+_MODULES_RIGHT_RE = re.compile(r'("modules-right"\s*:\s*\[)(\s*)')
 
-def expand_path(path: str) -> str:
-    """Expand ~ to home directory."""
-    return os.path.expanduser(path)
+# JSONC tokenizer: string literals are captured in group 1 and kept, line and
+# block comments and trailing commas (plus any whitespace or comments before
+# the closing ] or }) match without a group and are blanked out. Text between
+# matches is copied through unchanged by re.sub.
+_JSONC_TOKEN_RE = re.compile(
+    r'("(?:\\[\s\S]|[^"\\])*(?:"|\\?\Z))'
+    r'|//[^\n]*'
+    r'|/\*[\s\S]*?(?:\*/|\Z)'
+    r'|,(?:\s|//[^\n]*\n|/\*(?:[^*]|\*(?!/))*\*/)*(?=[}\]])'
+)
+_NON_NEWLINE_RE = re.compile(r'[^\n]')
+_JSON_WHITESPACE = ' \t\n\r'
 
 
 def backup_file(path: str) -> str:
-    """Create a .bak backup of a file. Returns backup path."""
+    """
+    Create a .bak backup of a file. Returns backup path.
+    Hard-links the original where the filesystem allows it, falling back to
+    a copy. Call it right before replace_file(), which gives the file a new
+    inode, so the backup keeps pointing at the original content.
+    """
     backup_path = path + ".bak"
-    shutil.copy2(path, backup_path)
+    if os.path.lexists(backup_path):
+        os.remove(backup_path)
+    try:
+        # Link the real file: os.link can link a symlink itself on Linux
+        os.link(os.path.realpath(path), backup_path)
+    except OSError:
+        shutil.copy2(path, backup_path)
     return backup_path
 
 
+def write_all(fd: int, data: bytes) -> None:
+    """Write all of data to an open file descriptor."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def replace_file(path: str, data: bytes) -> None:
+    """
+    Atomically replace a file's contents via a temp file and rename.
+    Symlinks are resolved first, so the file they point to is updated
+    rather than the link being replaced.
+    """
+    path = os.path.realpath(path)
+    tmp_path = path + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            write_all(fd, data)
+            os.fchmod(fd, stat.S_IMODE(os.stat(path).st_mode))
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
 def strip_jsonc_comments(content: str) -> str:
     """
-    Strip comments from JSONC content to produce valid JSON.
-    Handles // line comments and /* block comments */.
+    Strip comments and trailing commas from JSONC content to produce valid JSON.
+    Handles // line comments, /* block comments */ and trailing commas
+    before ] or }, in a single pass.
     Preserves strings containing comment-like sequences.
+    Stripped text is replaced by spaces (keeping newlines), so offsets in the
+    result match offsets in the original content.
     """
-    result = []
-    i = 0
-    in_string = False
-    escape_next = False
-
-    while i < len(content):
-        char = content[i]
-
-        if escape_next:
-            result.append(char)
-            escape_next = False
-            i += 1
-            continue
-
-        if char == '\\' and in_string:
-            result.append(char)
-            escape_next = True
-            i += 1
-            continue
-
-        if char == '"' and not escape_next:
-            in_string = not in_string
-            result.append(char)
-            i += 1
-            continue
-
-        if in_string:
-            result.append(char)
-            i += 1
-            continue
-
-        # Not in string - check for comments
-        if content[i:i+2] == '//':
-            # Line comment - skip to end of line
-            while i < len(content) and content[i] != '\n':
-                i += 1
-            continue
-
-        if content[i:i+2] == '/*':
-            # Block comment - skip to */
-            i += 2
-            while i < len(content) - 1 and content[i:i+2] != '*/':
-                i += 1
-            i += 2  # Skip the */
-            continue
-
-        result.append(char)
-        i += 1
-
-    return ''.join(result)
-
-
-def remove_trailing_commas(content: str) -> str:
-    """Remove trailing commas before ] or } to make valid JSON."""
-    content = re.sub(r',(\s*[}\]])', r'\1', content)
-    return content
-
-
-def parse_jsonc(content: str) -> dict:
-    """Parse JSONC content (JSON with comments and trailing commas)."""
+    return _JSONC_TOKEN_RE.sub(_blank_jsonc_token, content)
+
+
+def _blank_jsonc_token(match: re.Match) -> str:
+    """Keep string literals, blank out comments and trailing commas."""
+    if match.group(1) is not None:
+        return match.group(1)
+    return _NON_NEWLINE_RE.sub(' ', match.group())
+
+
+def parse_jsonc(content: str) -> tuple[dict, tuple[int, int]]:
+    """
+    Parse JSONC content (JSON with comments and trailing commas).
+    Returns the parsed value and the root object's end offsets: the index
+    just past its last member and the index of its closing brace. Unlike
+    rfind('}'), these ignore braces and commas in comments.
+    """
+    # strip_jsonc_comments preserves offsets, so positions in the stripped
+    # text are also positions in the original content
     stripped = strip_jsonc_comments(content)
-    stripped = remove_trailing_commas(stripped)
-    return json.loads(stripped)
+    start = len(stripped) - len(stripped.lstrip(_JSON_WHITESPACE))
+    config, end = json.JSONDecoder().raw_decode(stripped, start)
+    if stripped[end:].strip(_JSON_WHITESPACE):
+        raise json.JSONDecodeError("Extra data", stripped, end)
+
+    # Comments and trailing commas are blanked, so walking back over
+    # whitespace from the closing brace lands on the last member
+    close = end - 1
+    i = close - 1
+    while i >= 0 and stripped[i] in _JSON_WHITESPACE:
+        i -= 1
+    return config, (i + 1, close)
+
+
+def vpn_config_state(config: dict) -> tuple[bool, bool]:
+    """
+    Check a parsed config for the VPN module.
+    Returns whether "custom/vpn" is in modules-right and whether its module
+    definition exists at the root.
+    """
+    return "custom/vpn" in config.get("modules-right", []), "custom/vpn" in config
 
 
 def modify_config_jsonc(path: str) -> bool:
@@ -115,65 +157,107 @@ def modify_config_jsonc(path: str) -> bool:
         print(f"ERROR: Config file not found: {path}", file=sys.stderr)
         sys.exit(1)
 
-    with open(path, 'r') as f:
-        content = f.read()
-
-    # Parse to validate and check existing configuration
-    config = parse_jsonc(content)
+    data = Path(path).read_bytes()
+
+    # Fast path: a config with no comment markers that mentions custom/vpn
+    # is usually plain JSON, so json.loads can check the root keys without
+    # the JSONC tokenizer. Otherwise pyjson5 is tried when installed. It
+    # accepts all of JSON5, a wider grammar than JSONC, so its result only
+    # decides whether to skip; anything that needs editing goes through
+    # parse_jsonc().
+    config = None
+    if b'"custom/vpn"' in data:
+        if b'//' not in data and b'/*' not in data:
+            try:
+                config = json.loads(data)
+            except json.JSONDecodeError:
+                pass  # e.g. trailing commas
+        if config is None and pyjson5 is not None:
+            try:
+                config = pyjson5.loads(data.decode())
+            except (pyjson5.Json5Exception, UnicodeDecodeError):
+                pass
+        if not isinstance(config, dict) or not all(vpn_config_state(config)):
+            config = None
+
+    if config is None:
+        # Parse to validate and check existing configuration. This also gives
+        # the root object's end offsets, so nothing is parsed again below.
+        try:
+            content = data.decode()
+            config, root_end = parse_jsonc(content)
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            print(f"ERROR: Could not parse {path}: {e}", file=sys.stderr)
+            sys.exit(1)
 
-    # Check modules-right exists
-    if "modules-right" not in config:
-        print("ERROR: 'modules-right' not found in config", file=sys.stderr)
-        sys.exit(1)
+        # Check modules-right exists
+        if "modules-right" not in config:
+            print("ERROR: 'modules-right' not found in config", file=sys.stderr)
+            sys.exit(1)
 
     # Idempotency checks
-    has_vpn_in_modules = "custom/vpn" in config.get("modules-right", [])
-    has_vpn_definition = "custom/vpn" in config
+    has_vpn_in_modules, has_vpn_definition = vpn_config_state(config)
 
     if has_vpn_in_modules and has_vpn_definition:
         print(f"config.jsonc: Already configured, skipping")
         return False
 
-    # Backup before making changes
-    backup_path = backup_file(path)
-    print(f"Backed up: {path} -> {backup_path}")
+    # Match the file's line endings in the text inserted below
+    newline = '\r\n' if '\r\n' in content else '\n'
 
     modified = False
 
+    # Insertions into modules-right come before the end of the root object
+    # and shift its offsets by their length
+    if not has_vpn_definition:
+        member_end, last_brace_pos = root_end
+
     # Insert "custom/vpn" after "group/tray-expander" in modules-right
     if not has_vpn_in_modules:
         # Look for "group/tray-expander" specifically and insert after it
-        tray_pattern = r'("group/tray-expander"\s*)(,)'
-        tray_match = re.search(tray_pattern, content)
+        tray_match = _TRAY_RE.search(content)
 
         if tray_match:
             # Insert after "group/tray-expander",
             insert_pos = tray_match.end()
-            content = content[:insert_pos] + '\n    "custom/vpn",' + content[insert_pos:]
+            entry = newline + '    "custom/vpn",'
+            content = content[:insert_pos] + entry + content[insert_pos:]
+            if not has_vpn_definition:
+                member_end += len(entry)
+                last_brace_pos += len(entry)
             modified = True
         else:
             # Fallback: find modules-right array and insert at beginning
-            modules_pattern = r'("modules-right"\s*:\s*\[)(\s*)'
-            modules_match = re.search(modules_pattern, content)
+            modules_match = _MODULES_RIGHT_RE.search(content)
             if modules_match:
                 insert_pos = modules_match.end()
-                content = content[:insert_pos] + '"custom/vpn",\n    ' + content[insert_pos:]
+                entry = '"custom/vpn",' + newline + '    '
+                content = content[:insert_pos] + entry + content[insert_pos:]
+                if not has_vpn_definition:
+                    member_end += len(entry)
+                    last_brace_pos += len(entry)
                 modified = True
             else:
                 print("ERROR: Could not find modules-right array in config", file=sys.stderr)
                 sys.exit(1)
 
-    # Add the custom/vpn module definition before the final closing brace
+    # Add the custom/vpn module definition at the end of the root object
     if not has_vpn_definition:
-        # Find the final closing brace of the root object
-        last_brace_pos = content.rfind('}')
-        if last_brace_pos == -1:
+        if content[last_brace_pos] != '}':
             print("ERROR: Could not find closing brace in config", file=sys.stderr)
             sys.exit(1)
 
-        # Check if we need a leading comma (JSONC may have trailing commas)
-        pre_brace_content = content[:last_brace_pos].rstrip()
-        needs_comma = not pre_brace_content.endswith(',')
+        # Between the last member and the closing brace there may be a
+        # trailing comma and comments. Without comments, insert before the
+        # brace; otherwise insert right after the last member so a comment
+        # can't hide whether a comma is needed.
+        tail = content[member_end:last_brace_pos].strip()
+        if tail in ('', ','):
+            insert_pos = last_brace_pos
+            needs_comma = tail == '' and content[member_end - 1] != '{'
+        else:
+            insert_pos = member_end
+            needs_comma = content[member_end - 1] != '{'
 
         vpn_module = '''
   "custom/vpn": {
@@ -182,18 +266,22 @@ def modify_config_jsonc(path: str) -> bool:
     "exec": "~/.config/waybar/scripts/vpn-toggle.sh",
     "on-click": "~/.config/waybar/scripts/vpn-toggle.sh toggle",
     "interval": 5
-  }'''
+  }'''.replace('\n', newline)
 
         if needs_comma:
             vpn_module = ',' + vpn_module
 
-        # Insert before the final }
-        content = content[:last_brace_pos] + vpn_module + '\n' + content[last_brace_pos:]
+        if insert_pos == last_brace_pos:
+            vpn_module += newline
+        content = content[:insert_pos] + vpn_module + content[insert_pos:]
         modified = True
 
     if modified:
-        with open(path, 'w') as f:
-            f.write(content)
+        # Backup only once all checks have passed and the file is about to be
+        # replaced, so a hard-linked backup never outlives a failed run
+        backup_path = backup_file(path)
+        print(f"Backed up: {path} -> {backup_path}")
+        replace_file(path, content.encode())
 
         print(f"Modified: {path}")
         if not has_vpn_in_modules:
@@ -213,18 +301,17 @@ def modify_style_css(path: str) -> bool:
         print(f"ERROR: Style file not found: {path}", file=sys.stderr)
         sys.exit(1)
 
-    with open(path, 'r') as f:
-        content = f.read()
+    # Idempotency check: look for #custom-vpn rule in the mapped file
+    already_configured = False
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                already_configured = mm.find(b'#custom-vpn') != -1
 
-    # Idempotency check: look for #custom-vpn rule
-    if '#custom-vpn' in content:
+    if already_configured:
         print(f"style.css: Already configured, skipping")
         return False
 
-    # Backup
-    backup_path = backup_file(path)
-    print(f"Backed up: {path} -> {backup_path}")
-
     css_block = '''
 #custom-vpn {
   min-width: 12px;
@@ -233,8 +320,12 @@ def modify_style_css(path: str) -> bool:
 }
 '''
 
-    with open(path, 'a') as f:
-        f.write(css_block)
+    data = Path(path).read_bytes() + css_block.encode()
+
+    # Backup right before replacing the file
+    backup_path = backup_file(path)
+    print(f"Backed up: {path} -> {backup_path}")
+    replace_file(path, data)
 
     print(f"Modified: {path}")
     print("  - Appended #custom-vpn styling")
@@ -270,11 +361,11 @@ def create_vpn_script(path: str) -> bool:
     scripts_dir = os.path.dirname(path)
     script_content = get_vpn_script_content()
 
-    # Idempotency check: compare with existing file
-    if os.path.exists(path):
-        with open(path, 'r') as f:
-            existing_content = f.read()
-        if existing_content == script_content:
+    # Idempotency check: compare with existing file, using the size to rule
+    # out a mismatch without reading it
+    script_bytes = script_content.encode()
+    if os.path.exists(path) and os.path.getsize(path) == len(script_bytes):
+        if Path(path).read_bytes() == script_bytes:
             print(f"vpn-toggle.sh: Already configured, skipping")
             return False
 
@@ -283,11 +374,14 @@ def create_vpn_script(path: str) -> bool:
         os.makedirs(scripts_dir)
         print(f"Created directory: {scripts_dir}")
 
-    with open(path, 'w') as f:
-        f.write(script_content)
-
-    # Make executable
-    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755)
+    try:
+        write_all(fd, script_bytes)
+        # Make executable (the open mode is masked by umask and ignored for
+        # an existing file, so set the bits explicitly)
+        os.fchmod(fd, 0o755)
+    finally:
+        os.close(fd)
 
     print(f"Created: {path}")
     print("  - Made executable")
@@ -298,9 +392,9 @@ def create_vpn_script(path: str) -> bool:
 
 def main():
     """Main entry point."""
-    config_path = expand_path("~/.config/waybar/config.jsonc")
-    style_path = expand_path("~/.config/waybar/style.css")
-    script_path = expand_path("~/.config/waybar/scripts/vpn-toggle.sh")
+    config_path = os.path.join(_WAYBAR, "config.jsonc")
+    style_path = os.path.join(_WAYBAR, "style.css")
+    script_path = os.path.join(_WAYBAR, "scripts/vpn-toggle.sh")
 
     print("Fixing waybar config for VPN toggle support...\n")
 